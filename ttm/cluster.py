@@ -2,7 +2,7 @@
 
 from getopt import getopt, gnu_getopt
 from .types import *
-import sys, json
+import sys
 
 # math is not used directly, but it can be convenient for the 'eval'
 # function that is used with the 'random' clustering method.
@@ -193,7 +193,7 @@ def _cli(argv, infile, outfile):
     else:
         raise CliError(f"Unknown ttm cluster METHOD '{args[0]}'")
     # Apply clustering
-    lowdim = infile.column('lowdim', map_f=json.loads)
+    lowdim = infile.column('lowdim', map_f=json_loads)
     if 'split' in opts:
         split = opts['split']
         print(f"Splitting cluster '{split}' with {method.__name__}",
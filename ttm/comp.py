@@ -14,22 +14,10 @@ def _cluster_pairs(f: InputFile, sample: set):
     for _cluster, docs in _cluster2doc(f, sample).items():
         for c in combinations(sorted(docs), 2):
             yield c
-def _kappa(f: InputFile, g: InputFile, sample: set) -> tuple:
-    U = list(combinations(sample, 2))
-    F = set(_cluster_pairs(f, sample=sample))
-    G = set(_cluster_pairs(g, sample=sample))
-    #
-    p_o = 1 - ( len(F.symmetric_difference(G)) / len(U) )
-    p_F = bucket_probability(cluster_distribution(f.column('cluster')))
-    p_G = bucket_probability(cluster_distribution(g.column('cluster')))
-    p_e = p_F * p_G + (1 - p_F) * (1 - p_G)
-    #
-    kappa = (p_o - p_e) / (1 - p_e)
-    zoom = 1 / (1 - p_e)
-    return (kappa, zoom)
 def _kappa(f: InputFile, g: InputFile, sample: set) -> tuple:
     """
-    Memory-optimized version for large kappas (also seems to run faster)
+    Calculate kappa without materializing the set of all document pairs,
+    which keeps memory usage low for large samples
     """
     n_ids = len(sample)
     len_U = (n_ids**2 - n_ids) / 2    # Matrix of id x id minus diagonal and
@@ -326,7 +326,7 @@ def _cli(argv, infile, outfile):
     embeddings = []
     total_docs = len(infile.column('id'))
     if 'append' in opts:
-        embeddings.append(infile.column('highdim', map_f=json.loads))
+        embeddings.append(infile.column('highdim', map_f=json_loads))
     for filename in opts['include']:
         f = InputFile(filename)
         if len(f) != len(infile):
@@ -341,7 +341,7 @@ def _cli(argv, infile, outfile):
                 f"The row order in '{filename}' differs from the one found "
                 f"in the main input file.\nLine {line}: Mismatch between "
                 f"'{id_a}' (main input file) and '{id_b}' ({filename}).")
-        embeddings.append(iter(f.column('highdim', map_f=json.loads)))
+        embeddings.append(iter(f.column('highdim', map_f=json_loads)))
     for m, args in methods:
         embeddings.append(m(infile.column('content'), **args))
     if 'highdim_only' in opts:
@@ -1,12 +1,109 @@
 #!/usr/bin/env python3
 
 from getopt import gnu_getopt
+from collections import Counter
 from .types import *
 import json
 
+def _load_columns(infile: InputFile, lowdim: bool=True,
+                  dtype='float32') -> tuple:
+    """
+    Read the 'id', 'cluster' and (unless lowdim is False) 'lowdim'
+    columns in a single pass over the input file and return them as a
+    tuple of numpy arrays (ids, clusters, X). Any column missing from
+    the input file is returned as None. X is of the specified dtype.
+    """
+    import numpy as np
+    # Reading the header on its own would leave a partial iteration over
+    # stdin behind, so the cache is completed first
+    infile.ensure_loaded()
+    header = infile.header()
+    cols = [ 'id', 'cluster', 'lowdim' ] if lowdim else [ 'id', 'cluster' ]
+    cols = [ c for c in cols if c in header ]
+    i_id, i_cluster, i_lowdim = [ cols.index(c) if c in cols else None
+                                  for c in [ 'id', 'cluster', 'lowdim' ] ]
+    # A single contiguous matrix is used for all metrics, so that sklearn
+    # does not need to convert the data for each of them. Its width is
+    # only known once the first row has been parsed.
+    n = len(infile) - 1
+    ids, clusters, X = [], [], None
+    sidecar = _load_sidecar(infile, n) if i_lowdim != None else None
+    map_f = { 'lowdim': json_loads } if sidecar is None else {}
+    rows = infile.columns(cols, map_f=map_f)
+    for i, row in enumerate(rows):
+        if i_id != None: ids.append(row[i_id])
+        if i_cluster != None: clusters.append(row[i_cluster])
+        if i_lowdim != None and sidecar is None:
+            if X is None: X = np.empty((n, len(row[i_lowdim])),
+                                       dtype=dtype)
+            X[i] = row[i_lowdim]
+        elif i_lowdim != None:
+            if i == 0: first = row[i_lowdim]
+            last = row[i_lowdim]
+    if sidecar is not None:
+        # Only use the sidecar if it matches the first and last vectors
+        # stored in the input file, which remains authoritative
+        if n > 0:
+            first, last = json_loads(first), json_loads(last)
+        if n == 0 or (sidecar.shape[1] == len(first) == len(last) and
+                      np.allclose(sidecar[0], first,
+                                  rtol=1e-5, atol=1e-6) and
+                      np.allclose(sidecar[-1], last,
+                                  rtol=1e-5, atol=1e-6)):
+            X = sidecar if sidecar.dtype == dtype else sidecar.astype(dtype)
+        else:
+            X = load_lowdim_matrix(infile).astype(dtype, copy=False)
+    if i_id != None and infile._id_index is None:
+        # The ids have been read anyway, so InputFile.id_index is set here
+        # rather than making another pass over the file later on
+        infile._id_index = { d: i for i, d in enumerate(ids) }
+    ids = np.array(ids, dtype=object) if i_id != None else None
+    clusters = np.array(clusters, dtype=object) if i_cluster != None else None
+    if i_lowdim != None and X is None:
+        X = np.empty((0, 0), dtype=dtype)
+    return (ids, clusters, X)
+
+def _load_sidecar(infile: InputFile, n: int):
+    """
+    Return the lowdim vectors from the .npy sidecar of the input file (as
+    written by 'ttm redim --store-npy') as a read-only memory map, or None
+    if there is no sidecar with one row for each of the n documents, or
+    if the sidecar is older than the input file.
+    """
+    import os
+    import numpy as np
+    if infile.filename == '-': return None
+    path = npy_sidecar(infile.filename, 'lowdim')
+    if not os.path.isfile(path): return None
+    if os.path.getmtime(path) < os.path.getmtime(infile.filename):
+        return None
+    try:
+        X = np.load(path, mmap_mode='r')
+    except ValueError:
+        return None
+    if X.ndim != 2 or X.shape[0] != n: return None
+    return X
+
+def load_lowdim_matrix(infile: InputFile) -> 'np.ndarray':
+    """
+    Parse the json-serialized vectors in the 'lowdim' column directly
+    into a preallocated float32 matrix with one row per document, in
+    the order they appear in the input file.
+    """
+    import numpy as np
+    infile.ensure_loaded()
+    lowdim = infile.column('lowdim', map_f=json_loads)
+    X = np.empty((len(infile) - 1, len(lowdim.peek())), dtype=np.float32)
+    for i, v in enumerate(lowdim):
+        X[i] = v
+    return X
+
 def extract_X_y(infile: InputFile) -> tuple:
-    X = list(infile.column('lowdim', map_f=json.loads))
-    y = list(infile.column('cluster'))
+    _ids, y, X = _load_columns(infile)
+    if X is None: raise ColumnNotFound("Column 'lowdim' does not exist "
+                                       'in the input file')
+    if y is None: raise ColumnNotFound("Column 'cluster' does not exist "
+                                       'in the input file')
     return (X, y)
 
 def calinski_harabasz(X, y) -> float:
@@ -17,34 +114,241 @@ def davies_bouldin(X, y) -> float:
     from sklearn.metrics import davies_bouldin_score
     return davies_bouldin_score(X, y)
 
-def silhouette(X, y, metric='euclidean', sample_size=.2) -> tuple:
+def silhouette(X, y, metric='euclidean', sample_size=.2, min_samples=32,
+               max_samples=20000, chunk=None) -> tuple:
+    """
+    Calculate the Silhouette Coefficient on a random sample of the data.
+    The number of samples is capped at max_samples. If less than
+    min_samples or less than two samples per cluster would be drawn, the
+    coefficient is considered undefined and None is returned without
+    calculating anything. The pairwise distances are computed in chunks
+    of (roughly) chunk MiB on all available CPUs. If chunk is None, the
+    working_memory configured in sklearn is used.
+    """
+    from sklearn import config_context, get_config
     from sklearn.metrics import silhouette_score
-    samples = max(round(len(X) * sample_size), len(set(y))+1)
-    score = silhouette_score(X, y, metric=metric, sample_size=samples)
+    import numpy as np
+    k = len(np.unique(y))
+    samples = min(round(len(X) * sample_size), max_samples)
+    if samples < max(2*k, min_samples): return (None, samples)
+    if chunk == None: chunk = get_config()['working_memory']
+    with config_context(working_memory=chunk):
+        score = silhouette_score(X, y, metric=metric, sample_size=samples,
+                                 n_jobs=-1)
     return (score, samples)
 
+def silhouette_approx(X, y, metric='euclidean', eps=.1, delta=.01,
+                      chunk=None) -> tuple:
+    """
+    Approximate the Silhouette Coefficient without computing all O(N^2)
+    pairwise distances. Rather than averaging over all members of a
+    cluster, the mean distances a(i) and b(i) are estimated from a random
+    sample of reference points drawn from each cluster. The sample size
+    per cluster is chosen as
+
+        ceil( log(2*N*K / delta) / (2 * eps^2) )
+
+    which, by Hoeffding's inequality, bounds the additive error of every
+    single mean distance by eps (relative to the diameter of the data)
+    with probability of at least 1 - delta. The number of distance
+    computations is thus reduced to O(N*K*log(N*K/delta)/eps^2).
+
+    For the 'sqeuclidean' metric, the sum of distances between a point x
+    and all points c in a cluster can be computed exactly as
+
+        N_k*||x||^2 - 2*x.sum(c) + sum(||c||^2)
+
+    so no sampling is necessary and the result is exact in O(N*K).
+    Otherwise, the distances are computed in chunks of (roughly) chunk
+    MiB, just like in silhouette.
+    """
+    import numpy as np
+    from math import ceil, log
+    from sklearn.metrics import pairwise_distances_chunked
+    X = np.asarray(X, dtype=float)
+    labels, y = np.unique(y, return_inverse=True)
+    n, k = len(X), len(labels)
+    rows = np.arange(n)
+    onehot = np.zeros((n, k)); onehot[rows, y] = 1
+    sizes = onehot.sum(axis=0)
+    if metric == 'sqeuclidean':
+        norms = (X**2).sum(axis=1)
+        dist = np.outer(norms, sizes) - 2 * X @ (onehot.T @ X).T \
+                                      + onehot.T @ norms
+        counts = np.tile(sizes, (n, 1))
+        counts[rows, y] -= 1        # The distance to x itself is not counted
+        samples = n
+    else:
+        m = ceil(log(2*n*k / delta) / (2 * eps**2))
+        ref = np.concatenate([
+            np.random.choice(np.flatnonzero(y == c), min(m, int(sizes[c])),
+                             replace=False) for c in range(k) ])
+        dist = np.concatenate(list(pairwise_distances_chunked(
+            X, X[ref], metric=metric, n_jobs=-1, working_memory=chunk,
+            reduce_func=lambda D, _start: D @ onehot[ref])))
+        counts = np.tile(onehot[ref].sum(axis=0), (n, 1))
+        counts[ref, y[ref]] -= 1    # The distance to x itself is not counted
+        samples = len(ref)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_dist = dist / counts
+        a = mean_dist[rows, y]
+        mean_dist[rows, y] = np.inf
+        b = mean_dist.min(axis=1)
+        s = (b - a) / np.maximum(a, b)
+    # Points in singleton clusters have a silhouette of 0 by definition
+    s = np.where(sizes[y] > 1, np.nan_to_num(s), 0)
+    return (float(s.mean()), samples)
+
+def silhouette_simplified(X, y, metric='euclidean') -> tuple:
+    """
+    Calculate the simplified Silhouette Coefficient, which replaces the
+    mean distances a(i) and b(i) by the distance of each point to the
+    centroid of its own cluster and to the nearest other centroid,
+    respectively. This takes O(N*K) rather than O(N^2) distance
+    computations, so all points are used and no sampling is necessary.
+    Note that the result is generally not identical to the regular
+    Silhouette Coefficient, and that it is mostly meaningful for metrics
+    in which a cluster is well represented by its mean, such as the
+    'euclidean' metric.
+    """
+    import numpy as np
+    from sklearn.metrics import pairwise_distances
+    X = np.asarray(X, dtype=float)
+    labels, y = np.unique(y, return_inverse=True)
+    n, k = len(X), len(labels)
+    if k < 2: return (None, n)
+    rows = np.arange(n)
+    sizes = np.bincount(y, minlength=k)
+    centroids = np.zeros((k, X.shape[1]))
+    np.add.at(centroids, y, X)
+    centroids /= sizes[:,np.newaxis]
+    # sklearn is used for the distances, so the same metric names are
+    # accepted as in the regular silhouette
+    dist = pairwise_distances(X, centroids, metric=metric)
+    a = dist[rows, y]
+    dist[rows, y] = np.inf
+    b = dist.min(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = (b - a) / np.maximum(a, b)
+    # Points in singleton clusters have a silhouette of 0 by definition
+    s = np.where(sizes[y] > 1, np.nan_to_num(s), 0)
+    return (float(s.mean()), n)
+
+def _paired_distance_sum(M, pairs, metric='euclidean', block=2**16) -> float:
+    """
+    Sum the distances between the rows of M indexed by each of the
+    (N, 2) index pairs. The pairs are processed in blocks, so that the
+    gathered rows never take up more than a bounded amount of memory.
+    """
+    from scipy.spatial.distance import cdist
+    from sklearn.metrics.pairwise import paired_distances, PAIRED_DISTANCES
+    import numpy as np
+    total = 0.
+    for i in range(0, len(pairs), block):
+        ia, ib = pairs[i:i+block,0], pairs[i:i+block,1]
+        if metric in ('euclidean', 'sqeuclidean'):
+            D = M[ia] - M[ib]
+            d = np.einsum('ij,ij->i', D, D, dtype=float)
+            total += (np.sqrt(d) if metric == 'euclidean' else d).sum()
+        elif metric in PAIRED_DISTANCES:
+            total += paired_distances(M[ia], M[ib], metric=metric) \
+                     .sum(dtype=float)
+        else:
+            A, B = M[ia], M[ib]
+            total += sum(( cdist(A[k:k+1], B[k:k+1], metric=metric).sum()
+                           for k in range(len(A)) ))
+    return float(total)
+
 def psq_distance(infile: InputFile, psq_pairs: PsqPairs,
-                 metric='euclidean', sample_size=1.) -> float:
-    from scipy.spatial.distance import pdist, cdist, euclidean
-    from random import sample
+                 metric='euclidean', sample_size=1., jobs=1) -> float:
     infile.ensure_loaded()
-    v = { d: v for d, v in zip(infile.column('id'),
-                               infile.column('lowdim', map_f=json.loads)) }
-    a = [ v[a] for a, _ in psq_pairs ]
-    b = [ v[b] for _, b in psq_pairs ]
-    if len(a) != len(b): raise Exception('Unexpected data length mismatch')
-    page_sum = sum((cdist([v[a]], [v[b]], metric=metric).sum()
-                                                    for a, b in psq_pairs))
-    X = list(v.values()) if sample_size >= 1. else \
-        list(sample(list(v.values()), round(sample_size*len(v))))
-    return ( page_sum / len(a) ) \
-           / ( 2 * pdist(X, metric=metric).sum() / (len(X)**2 - len(X)) )
+    ids, _clusters, M = _load_columns(infile)
+    if ids is None: raise ColumnNotFound("Column 'id' does not exist "
+                                         'in the input file')
+    if M is None: raise ColumnNotFound("Column 'lowdim' does not exist "
+                                       'in the input file')
+    return _psq_distance(ids, M, psq_pairs, metric=metric,
+                         sample_size=sample_size, jobs=jobs,
+                         index=infile.id_index)
+
+def _psq_distance(ids, M, psq_pairs: PsqPairs, metric='euclidean',
+                  sample_size=1., jobs=1, index: dict=None) -> float:
+    """
+    Same as psq_distance, but operating on the ids and the lowdim matrix
+    M as returned by _load_columns.
+    """
+    import numpy as np
+    pairs = psq_pairs.as_ndarray(ids, index=index)
+    page_sum = _paired_distance_sum(M, pairs, metric=metric)
+    X = M if sample_size >= 1. else \
+        M[np.random.choice(len(M), round(sample_size*len(M)), replace=False)]
+    n = len(X)
+    total_sum = pdist_sum_streaming(X, metric=metric, n_jobs=jobs)
+    return ( page_sum / len(pairs) ) \
+           / ( 2 * total_sum / (n**2 - n) )
+
+def pdist_sum_streaming(X, metric='euclidean', block=None,
+                        n_jobs=1) -> float:
+    """
+    Calculate the same value as pdist(X, metric=metric).sum(), i. e. the
+    sum of the distances between all pairs of distinct rows in X, but
+    without holding all O(N^2) distances in memory. Instead, the upper
+    triangle of the distance matrix is summed in blocks of rows, so that
+    only O(block*N) distances are held at any time. If block is None,
+    it is chosen so that each block holds about 2**20 distances. For the
+    'sqeuclidean' metric, the sum is calculated directly in O(N).
+
+    If n_jobs is not 1, the distances are calculated in parallel with
+    sklearn's pairwise_distances_chunked instead, using up to n_jobs CPUs
+    (or all CPUs for -1). Since this calculates both triangles of the
+    distance matrix, it only pays off with more than two CPUs.
+    """
+    from scipy.spatial.distance import cdist
+    import numpy as np
+    X, n = np.asarray(X, dtype=float), len(X)
+    if metric == 'sqeuclidean':
+        # sum_{i<j} ||x_i - x_j||^2 = n * sum_i ||x_i||^2 - ||sum_i x_i||^2
+        return float(n * (X**2).sum() - (X.sum(axis=0)**2).sum())
+    if n_jobs != 1:
+        from sklearn.metrics import pairwise_distances_chunked
+        # The diagonal is zero, so half the full sum is the upper triangle
+        chunks = pairwise_distances_chunked(X, metric=metric, n_jobs=n_jobs,
+                        reduce_func=lambda D, _start: D.sum(axis=1))
+        return float(sum(( c.sum() for c in chunks )) / 2)
+    if block is None: block = max(1, 2**20 // max(n, 1))
+    # For euclidean distances between vectors with more than a handful of
+    # dimensions, computing ||a||^2 + ||b||^2 - 2*a.b lets a single matrix
+    # product do most of the work for each block. For very few dimensions,
+    # the extra temporaries make this slower than cdist.
+    gemm = metric == 'euclidean' and X.ndim == 2 and X.shape[1] >= 16
+    if gemm: norms = np.einsum('ij,ij->i', X, X)
+    total = 0.
+    for i in range(0, n, block):
+        if gemm:
+            D = norms[i:i+block,np.newaxis] + norms[np.newaxis,i:] \
+                - 2 * (X[i:i+block] @ X[i:].T)
+            D = np.sqrt(np.maximum(D, 0, out=D), out=D)
+        else:
+            D = cdist(X[i:i+block], X[i:], metric=metric)
+        # The diagonal and lower triangle within the block are skipped
+        total += np.triu(D[:,:block], k=1).sum() + D[:,block:].sum()
+    return float(total)
 
 def cluster_distribution(cluster: Column, absolute: bool=False) -> dict:
-    counts = dict()
-    for c in cluster:
-        if c not in counts: counts[c] = 0
-        counts[c] += 1
+    """
+    Count the documents in each cluster. The argument can be either a
+    Column or a numpy array holding the cluster id of each document.
+    Unless absolute is True, the counts are reported as relative cluster
+    sizes, sorted by size.
+    """
+    import numpy as np
+    if isinstance(cluster, np.ndarray):
+        ids, first, n = np.unique(cluster, return_index=True,
+                                  return_counts=True)
+        order = first.argsort()     # Preserve order of first appearance
+        counts = { c: int(k) for c, k in zip(ids[order], n[order]) }
+    else:
+        counts = dict(Counter(cluster))
     if absolute: return counts
     total = sum(counts.values())
     counts = { k: v/total for k, v in
@@ -56,24 +360,38 @@ def bucket_probability(cluster_distribution: dict) -> float:
     Random bucket score. Given a set of specifically sized buckets, and
     assuming that pages are randomly sorted into buckets (respecting the
     bucket sizes), what is the probability that any two pages appear in
-    the same bucket.
+    the same bucket. The bucket sizes can be specified either as a dict
+    as returned by cluster_distribution or as a numpy array of relative
+    cluster sizes.
     """
-    return sum(( x**2 for x in cluster_distribution.values() ))
+    import numpy as np
+    if isinstance(cluster_distribution, np.ndarray):
+        v = cluster_distribution
+    else:
+        v = np.fromiter(cluster_distribution.values(), dtype=np.float64,
+                        count=len(cluster_distribution))
+    return float(v @ v)
 
 def psq_count(infile: InputFile, psq_pairs: PsqPairs) -> float:
     """
     Given a list of pages following one another, calculate how many of these
     pairs of pages can be found in the same cluster.
     """
-    n_matches = 0
-    n_pairs = 0
     infile.ensure_loaded()
-    doc2cluster = { d: c for d, c in
-                    zip(infile.column('id'), infile.column('cluster')) }
-    for a, b in psq_pairs:
-        if doc2cluster[a] == doc2cluster[b]: n_matches += 1
-        n_pairs += 1
-    return n_matches / n_pairs
+    ids, clusters, _X = _load_columns(infile, lowdim=False)
+    return _psq_count(ids, clusters, psq_pairs, index=infile.id_index)
+
+def _psq_count(ids, clusters, psq_pairs: PsqPairs, index: dict=None) -> float:
+    """
+    Same as psq_count, but operating on the id and cluster arrays as
+    returned by _load_columns. The clusters may also be given as integer
+    cluster codes, which are much cheaper to compare than strings.
+    """
+    import numpy as np
+    if clusters.dtype == object:
+        clusters = np.unique(clusters, return_inverse=True)[1]
+    pairs = psq_pairs.as_ndarray(ids, index=index)
+    return float((clusters[pairs[:,0]] == clusters[pairs[:,1]]).mean())
 
 def psq_score(psq_count, cluster_distribution) -> tuple:
     """
@@ -117,7 +435,10 @@ Usage: ttm [OPT]... eval [COMMAND-OPTION]... FILE [FILE]...
 'ttm eval' takes one or more file names as positional arguments.
 These files are supposed to contain a corpus processed by ttm. On
 the fly decompression works just like it does with the '-i' option.
-The evaluation is done for each of the specified files.
+The evaluation is done for each of the specified files. If a FILE has
+a sidecar 'FILE.lowdim.npy' as written by 'ttm redim --store-npy',
+the lowdim vectors are loaded from that sidecar rather than parsed
+from FILE, as long as the sidecar matches the vectors in FILE.
 
 Evaluation Metrics
     cluster-distribution
@@ -199,6 +520,14 @@ Command Options
                 lowdim representation of the corpus does not fit into
                 memory as a dense matrix, or it may simply be convenient
                 if those metrics are not needed.
+    --lowdim-dtype DTYPE
+                Numpy data type used to hold the lowdim representation of
+                the corpus in memory. One of 'float16', 'float32' and
+                'float64'. With 'float16', the matrix only takes half the
+                memory, and gathering the vectors of subsequent pages for
+                the psq-distance moves half the bytes, at the cost of a
+                small loss in precision. The separation metrics always
+                operate on at least 'float32'. Default: 'float32'.
     --silhouette-metric METRIC
                 Distance metric used for calculating the silhouette
                 coefficient. For a full list of supported metrics see
@@ -207,6 +536,39 @@ Command Options
     --silhouette-sample-size N
                 The relative number of samples to draw from the data when
                 calculating the silhouette coefficient. Default: 0.2.
+    --silhouette-min-samples N
+                Report the silhouette coefficient as undefined rather than
+                drawing less than N samples (or less than two samples
+                per cluster). Default: 32.
+    --silhouette-max-samples N
+                Draw no more than N samples when calculating the
+                silhouette coefficient. Default: 20000.
+    --silhouette-chunk N
+                Compute the pairwise distances needed for the silhouette
+                coefficient in chunks of about N MiB. Smaller chunks may
+                fit better into the CPU caches, larger chunks reduce the
+                overhead per chunk. This option has no effect with
+                --silhouette-simplified. Default: sklearn's working_memory,
+                which is 1024 unless configured otherwise.
+    --silhouette-approx
+                Rather than calculating the exact silhouette coefficient
+                on a sample of the data, approximate the coefficient for
+                all points by estimating the mean intra- and inter-cluster
+                distances from a fixed number of reference points per
+                cluster. This scales to very large corpora. The options
+                --silhouette-sample-size, --silhouette-min-samples and
+                --silhouette-max-samples are ignored when approximating.
+                For the 'sqeuclidean' metric, the result is exact. For
+                further information see 'pydoc ttm.eval.silhouette_approx'.
+    --silhouette-simplified
+                Calculate the simplified silhouette coefficient, which
+                uses the distances to the cluster centroids rather than
+                the mean distances to all cluster members. This is very
+                fast and uses all points, but it is not identical to the
+                regular silhouette coefficient. The options ignored by
+                --silhouette-approx are ignored here as well, and the
+                two options cannot be combined. For further information
+                see 'pydoc ttm.eval.silhouette_simplified'.
     --skip-psq-distance
                 Do not calculate the psq-distance. This may be convenient
                 if the psq-distance metric is not needed since calculating
@@ -223,16 +585,42 @@ Command Options
                 distance between subsequent pages will always be calculated
                 fully, since this can be done in O(N). To disable sampling,
                 specify a value of 1.0. Default: 1.0.
+    --psq-distance-jobs N
+                Calculate the average distance between points on up to N
+                CPUs, or on all CPUs if N is -1. Since the parallel
+                implementation needs to calculate twice as many distances,
+                this is only faster with more than two CPUs. When
+                evaluating several FILEs with --jobs, keep in mind that
+                each process will use up to N CPUs. Default: 1.
     --psq-pairs FILE
                 Header-less tsv-file containing document id pairs
                 representing consecutive pages. The file must contain
                 exactly one pair of pages per line, separated by a
                 single tab character. This input is required to calculate
                 the psq-score.
+    -j N, --jobs N
+                Evaluate up to N of the specified FILEs in parallel, using
+                a separate process for each FILE. If N is 0, the number of
+                CPUs is used. Standard input ('-') is always evaluated in
+                the main process, alongside the other FILEs. Default: 1.
+    --cache-dir DIR
+                Store the evaluation results for each FILE in DIR and
+                reuse them when the same FILE is evaluated again with the
+                same options. Cached results are identified by the path,
+                size and modification time of FILE, the contents of the
+                psq-pairs file and all options affecting the metrics.
+                Note that a cached result also includes the random sample
+                drawn for the silhouette coefficient. FILEs read from
+                stdin are never cached.
     -h, --help  Print this help message and exit.
 """.lstrip()
 
 class EvaluationResult():
+    __slots__ = ( 'model_name', 'cluster_distribution', 'clusters',
+                  'highdim_size', 'lowdim_size', 'calinski_harabasz',
+                  'davies_bouldin', 'silhouette', 'silhouette_samples',
+                  'psq_distance', 'psq_distance_sample_size', 'psq_count',
+                  'psq_score', 'psq_score_zoom', '_probs_np' )
     def __init__(self, model_name: str=None):
         self.model_name: str = model_name
         self.cluster_distribution: dict = dict()
@@ -248,78 +636,78 @@ class EvaluationResult():
         self.psq_count: float = None
         self.psq_score: float = None
         self.psq_score_zoom: float = None
-
+        self._probs_np = None
+
+_cell_parsers = {
+    'model_name': str,
+    'cluster_distribution': lambda v: json_loads(v) if v.strip() else v,
+    'clusters': int, 'highdim_size': int, 'lowdim_size': int,
+    'silhouette_samples': int,
+    'calinski_harabasz': float, 'davies_bouldin': float, 'silhouette': float,
+    'psq_distance': float, 'psq_distance_sample_size': float,
+    'psq_count': float, 'psq_score': float, 'psq_score_zoom': float,
+}
+_undefined_cells = frozenset(['N/A', 'undefined'])
 def _parse_tsv(f: InputFile) -> EvaluationResult:
-    def _parse_cell(key: str, val: str):
-        if val in ['N/A', 'undefined']: return None
-        if key == 'model_name': return val
-        elif key == 'cluster_distribution':
-            if not val.strip(): return val
-            return json.loads(val)
-        elif key in ['clusters', 'highdim_size', 'lowdim_size',
-                     'silhouette_samples']:
-            return int(val)
-        elif key in ['calinski_harabasz', 'davies_bouldin', 'silhouette',
-                     'psq_distance', 'psq_distance_sample_size',
-                     'psq_count', 'psq_score', 'psq_score_zoom' ]:
-            return float(val)
-        else: raise ValueError(f"Unknown key '{key}'")
     lines = map(lambda x: x.split('\t'), iter(f))
     header = next(lines)
+    parsers = [ (i, k, _cell_parsers[k]) for i, k in enumerate(header)
+                if k in _tsv_header ]
     for l in lines:
         result = EvaluationResult()
-        for i, v in enumerate(l):
-            k = header[i]
-            if k not in _tsv_header: continue
-            v = _parse_cell(k, v)
-            result.__dict__[k] = v
+        for i, k, parse in parsers:
+            v = l[i]
+            setattr(result, k, None if v in _undefined_cells else parse(v))
         yield result
 
+_bar = 51*'*'
 def _print_text(r: EvaluationResult):
-    print(f'Evaluation results for {r.model_name}')
+    lines = [ f'Evaluation results for {r.model_name}' ]
+    append = lines.append
     for cluster, quota in r.cluster_distribution.items():
-        print(3*' ', f'{cluster:>5}    {100*quota:6.2f} %    ',
-              round(quota*50)*'*')
+        append(f'    {cluster:>5}    {100*quota:6.2f} %     '
+               f'{_bar[:round(quota*50)]}')
     if r.highdim_size == None:
-        print(f'  highdim-size             N/A')
+        append(f'  highdim-size             N/A')
     else:
-        print(f'  highdim-size  {r.highdim_size:>14}')
+        append(f'  highdim-size  {r.highdim_size:>14}')
     if r.lowdim_size == None:
-        print(f'  lowdim-size              N/A')
+        append(f'  lowdim-size              N/A')
     else:
-        print(f'  lowdim-size   {r.lowdim_size:>14}')
+        append(f'  lowdim-size   {r.lowdim_size:>14}')
     if r.calinski_harabasz == None:
-        print(f'  calinski-harabasz  undefined')
+        append(f'  calinski-harabasz  undefined')
     else:
-        print(f'  calinski-harabasz     {r.calinski_harabasz:<.4f}')
+        append(f'  calinski-harabasz     {r.calinski_harabasz:<.4f}')
     if r.davies_bouldin == None:
-        print(f'  davies-bouldin     undefined')
+        append(f'  davies-bouldin     undefined')
     else:
-        print(f'  davies-bouldin        {r.davies_bouldin:<.4f}')
+        append(f'  davies-bouldin        {r.davies_bouldin:<.4f}')
     if r.silhouette == None:
-        print(f'  silhouette         undefined')
+        append(f'  silhouette         undefined')
     else:
-        print(f'  silhouette           {r.silhouette:>7.4f}  '
-              f'({r.silhouette_samples} samples)')
+        append(f'  silhouette           {r.silhouette:>7.4f}  '
+               f'({r.silhouette_samples} samples)')
     if r.psq_distance == None:
-        print(f'  psq-distance             N/A')
+        append(f'  psq-distance             N/A')
     else:
         if r.psq_distance_sample_size == 1.:
-            print(f'  psq-distance          {r.psq_distance:<.4f}')
+            append(f'  psq-distance          {r.psq_distance:<.4f}')
         else:
-            print(f'  psq-distance          {r.psq_distance:<.4f}  '
-                  f'(avg on {r.psq_distance_sample_size} of all points)')
+            append(f'  psq-distance          {r.psq_distance:<.4f}  '
+                   f'(avg on {r.psq_distance_sample_size} of all points)')
     if r.psq_count == None:
-        print(f'  psq-count                N/A')
-        print(f'  psq-score                N/A')
+        append(f'  psq-count                N/A')
+        append(f'  psq-score                N/A')
     else:
-        print(f'  psq-count            {r.psq_count:>7.4f}')
+        append(f'  psq-count            {r.psq_count:>7.4f}')
         if r.psq_score == None:
-            print(f'  psq-score          undefined')
+            append(f'  psq-score          undefined')
         else:
-            print(f'  psq-score            {r.psq_score:>7.4f}  '
-                  f'(zoom {r.psq_score_zoom:.2f})')
-    print()
+            append(f'  psq-score            {r.psq_score:>7.4f}  '
+                   f'(zoom {r.psq_score_zoom:.2f})')
+    append('')
+    sys.stdout.write('\n'.join(lines) + '\n')
 
 _tsv_header = [
             'model_name', 'psq_score', 'psq_score_zoom', 'psq_count',
@@ -330,34 +718,181 @@ _tsv_header = [
 ]
 def _print_tsv_header():
     print(*_tsv_header, sep='\t', end='\n')
-def _print_tsv(r: EvaluationResult):
-    if r.highdim_size == None: r.highdim_size = 'N/A'
-    if r.lowdim_size == None: r.lowdim_size = 'N/A'
-    if r.calinski_harabasz == None: r.calinski_harabasz = 'undefined'
-    if r.davies_bouldin == None: r.davies_bouldin = 'undefined'
-    if r.silhouette == None:
-        r.silhouette, r.silhouette_samples = 'undefined', 'undefined'
-    if r.psq_distance == None:
-        r.psq_distace, r.psq_distance_sample_size = 'undefined', 'undefined'
-    if r.psq_count == None:
-        r.psq_distace, r.psq_distance_sample_size = 'N/A', 'N/A'
-        r.psq_count = 'N/A'
-        r.psq_score, r.psq_score_zoom = 'N/A', 'N/A'
-    elif r.psq_score == None:
-        r.psq_score, r.psq_score_zoom = 'undefined', 'undefined'
-    row = [ r.model_name, r.psq_score, r.psq_score_zoom, r.psq_count,
-            r.psq_distance, r.psq_distance_sample_size,
-            r.silhouette, r.silhouette_samples, r.davies_bouldin,
-            r.calinski_harabasz, r.highdim_size, r.lowdim_size,
+def _print_tsv(r: EvaluationResult, buf=None):
+    """
+    Print a single result as a tsv row. If buf (a file-like object such
+    as io.StringIO) is specified, the row is written to buf rather than
+    stdout. This allows to write many rows with a single call.
+    """
+    # Missing values are reported as either 'N/A' (the metric was not
+    # requested or the data required is missing) or 'undefined' (the
+    # metric was requested, but is undefined for the given data).
+    psq_missing = 'N/A' if r.psq_count == None else 'undefined'
+    has_score = r.psq_score != None
+    has_distance = r.psq_distance != None
+    has_silhouette = r.silhouette != None
+    row = [ r.model_name,
+            r.psq_score if has_score else psq_missing,
+            r.psq_score_zoom if has_score else psq_missing,
+            'N/A' if r.psq_count == None else r.psq_count,
+            r.psq_distance if has_distance else psq_missing,
+            r.psq_distance_sample_size if has_distance else psq_missing,
+            r.silhouette if has_silhouette else 'undefined',
+            r.silhouette_samples if has_silhouette else 'undefined',
+            'undefined' if r.davies_bouldin == None else r.davies_bouldin,
+            'undefined' if r.calinski_harabasz == None \
+                        else r.calinski_harabasz,
+            'N/A' if r.highdim_size == None else r.highdim_size,
+            'N/A' if r.lowdim_size == None else r.lowdim_size,
             r.clusters, json.dumps(r.cluster_distribution) ]
-    print(*row, sep='\t', end='\n')
+    (sys.stdout if buf == None else buf).write('\t'.join(map(str, row))+'\n')
+
+def _evaluate_file(filename: str, opts: dict, silhouette_f,
+                   silhouette_opts: dict, psq_distance_opts: dict):
+    """
+    Calculate all evaluation metrics for a single file, as configured via
+    the command line options parsed in _cli.
+    """
+    import numpy as np
+    f = InputFile(filename)
+    result = EvaluationResult(filename)
+    f.ensure_loaded()
+    separation = 'skip_separation_metrics' not in opts
+    distance = 'psq_pairs' in opts and not 'skip_psq_distance' in opts
+    # The lowdim column is parsed once and shared by all metrics using it
+    ids, y, X = _load_columns(f, lowdim=separation or distance,
+                              dtype=opts.get('lowdim_dtype', 'float32'))
+    if y is not None:
+        result.cluster_distribution = cluster_distribution(y)
+    else:
+        result.cluster_distribution = dict()
+    result.clusters = len(result.cluster_distribution)
+    result._probs_np = np.fromiter(result.cluster_distribution.values(),
+                                   dtype=float, count=result.clusters)
+    try:
+        result.highdim_size = \
+                        len(f.column('highdim', map_f=json_loads).peek())
+    except ColumnNotFound:
+        result.highdim_size = None
+    if X is not None:
+        result.lowdim_size = X.shape[1]
+    else:
+        try:
+            result.lowdim_size = \
+                        len(f.column('lowdim', map_f=json_loads).peek())
+        except ColumnNotFound:
+            result.lowdim_size = None
+    # Integer cluster codes are shared by all metrics using the clusters
+    labels = np.unique(y, return_inverse=True)[1].astype(np.int32) \
+             if y is not None else None
+    if separation and len(result.cluster_distribution) > 1 \
+                  and X is not None:
+        # Half precision is too coarse (and, lacking hardware support,
+        # too slow) for the separation metrics
+        X_sep = X.astype(np.float32) if X.dtype == np.float16 else X
+        result.calinski_harabasz = calinski_harabasz(X_sep, labels)
+        result.davies_bouldin = davies_bouldin(X_sep, labels)
+        result.silhouette, result.silhouette_samples = \
+                            silhouette_f(X_sep, labels, **silhouette_opts)
+        del X_sep
+    else:
+        result.calinski_harabasz = None
+        result.davies_bouldin = None
+        result.silhouette = None
+    if 'psq_pairs' in opts and result.clusters > 0:
+        if ids is None: raise ColumnNotFound("Column 'id' does not exist "
+                                             'in the input file')
+        result.psq_count = _psq_count(ids, labels, opts['psq_pairs'],
+                                      index=f.id_index)
+        if len(result.cluster_distribution) > 1:
+            result.psq_score, result.psq_score_zoom = \
+                            psq_score(result.psq_count, result._probs_np)
+        else:
+            result.psq_score, result.psq_score_zoom = None, None
+    else:
+        result.psq_count = None
+        result.psq_score, result.psq_score_zoom = None, None
+    if distance:
+        if ids is None: raise ColumnNotFound("Column 'id' does not exist "
+                                             'in the input file')
+        if X is None: raise ColumnNotFound("Column 'lowdim' does not exist "
+                                           'in the input file')
+        result.psq_distance = _psq_distance(ids, X, opts['psq_pairs'],
+                                            index=f.id_index,
+                                            **psq_distance_opts)
+        result.psq_distance_sample_size = \
+                            psq_distance_opts.get('sample_size', 1.)
+    else:
+        result.psq_distance, result.psq_distance_sample_size = None, None
+    return result
+
+def _cache_params(opts: dict, silhouette_f, silhouette_opts: dict,
+                  psq_distance_opts: dict) -> tuple:
+    """
+    Collect all parameters, other than the input file itself, which
+    affect the evaluation results, so that they can be hashed into the
+    cache key used by _evaluate_file_cached.
+    """
+    from hashlib import blake2b
+    if 'psq_pairs' in opts:
+        h = blake2b(digest_size=16)
+        for a, b in opts['psq_pairs']:
+            h.update(f'{a}\t{b}\n'.encode())
+        psq_pairs = h.hexdigest()
+    else:
+        psq_pairs = None
+    return ( psq_pairs, 'skip_separation_metrics' in opts,
+             'skip_psq_distance' in opts, opts.get('lowdim_dtype'),
+             silhouette_f.__name__, sorted(silhouette_opts.items()),
+             sorted(psq_distance_opts.items()) )
+
+def _evaluate_file_cached(filename: str, cache_dir: str, cache_params: tuple,
+                          **kwargs):
+    """
+    Same as _evaluate_file, but look up the result in cache_dir first and
+    store it there if it has not been cached before.
+    """
+    import os, pickle
+    from hashlib import blake2b
+    if filename == '-': return _evaluate_file(filename, **kwargs)
+    stat = os.stat(filename)
+    key = repr(( os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                 cache_params ))
+    path = os.path.join(cache_dir, blake2b(key.encode(), digest_size=16)
+                                   .hexdigest() + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        result = EvaluationResult()
+        for k in EvaluationResult.__slots__: setattr(result, k, state[k])
+        result.model_name = filename
+        return result
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass    # Not cached yet (or the cache file is unusable)
+    result = _evaluate_file(filename, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    state = { k: getattr(result, k) for k in EvaluationResult.__slots__ }
+    # Write to a temporary file first, so that concurrent runs never see
+    # a partially written cache file
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp, path)
+    return result
 
 def _cli(argv, infile, outfile):
-    all_opts, filenames = gnu_getopt(argv, 'hf:', ['help', 'format=',
+    import os
+    from io import StringIO
+    from functools import partial
+    all_opts, filenames = gnu_getopt(argv, 'hf:j:', ['help', 'format=',
+            'jobs=',
             'include=', 'silhouette-metric=', 'silhouette-sample-size=',
             'psq-pairs=', 'skip-separation-metrics', 'skip-psq-distance',
-            'psq-distance-metric=', 'psq-distance-sample-size='])
-    short2long = { '-h': '--help', '-f': '--format' }
+            'psq-distance-metric=', 'psq-distance-sample-size=',
+            'silhouette-min-samples=', 'silhouette-max-samples=',
+            'silhouette-approx', 'silhouette-simplified', 'lowdim-dtype=',
+            'cache-dir=', 'silhouette-chunk=', 'psq-distance-jobs='])
+    short2long = { '-h': '--help', '-f': '--format', '-j': '--jobs' }
     opts = { short2long.get(k, k).lstrip('-').replace('-', '_'): v
              for k, v in all_opts }
     opts['include'] = [ v for k, v in all_opts if k == '--include' ]
@@ -366,86 +901,74 @@ def _cli(argv, infile, outfile):
     if len(filenames) < 1 and len(opts['include']) < 1:
         raise CliError('At least one FILE or --include argument is required '
                        'for ttm eval')
-    files = [ InputFile(f) for f in filenames ]
     if not 'format' in opts: opts['format'] = 'text'
+    if opts['format'] not in ['text', 'tsv']:
+        raise CliError("Unknown FORMAT '{}'".format(opts['format']))
+    if not 'lowdim_dtype' in opts: opts['lowdim_dtype'] = 'float32'
+    if opts['lowdim_dtype'] not in ['float16', 'float32', 'float64']:
+        raise CliError("Unknown DTYPE '{}'".format(opts['lowdim_dtype']))
+    jobs = int(opts.get('jobs', 1))
+    if jobs < 0: raise CliError('--jobs must be a non-negative integer')
+    if jobs == 0: jobs = os.cpu_count() or 1
     if 'psq_pairs' in opts:
         opts['psq_pairs'] = PsqPairs(opts['psq_pairs'])
     silhouette_opts = dict()
     psq_distance_opts = dict()
     for k, v in opts.items():
-        if k.startswith('silhouette_'):
+        if k in ['silhouette_approx', 'silhouette_simplified']:
+            continue
+        elif k.startswith('silhouette_'):
             k = k.replace('silhouette_', '')
             if k == 'sample_size': v = float(v)
+            if k in ['min_samples', 'max_samples', 'chunk']: v = int(v)
             silhouette_opts[k] = v
         elif k.startswith('psq_distance_'):
             k = k.replace('psq_distance_', '')
             if k == 'sample_size': v = float(v)
+            if k == 'jobs': v = int(v)
             psq_distance_opts[k] = v
-    if opts['format'] == 'tsv': _print_tsv_header()
-    for f in opts['include']:
-        for result in _parse_tsv(InputFile(f)):
-            if opts['format'] == 'text':
-                _print_text(result)
-            elif opts['format'] == 'tsv':
-                _print_tsv(result)
-            else:
-                raise CliError("Unknown FORMAT '{}'".format(opts['format']))
-    for f, name in zip(files, filenames):
-        result = EvaluationResult(name)
-        f.ensure_loaded()
-        try:
-            result.cluster_distribution = \
-                                cluster_distribution(f.column('cluster'))
-        except ColumnNotFound:
-            result.cluster_distribution = dict()
-        result.clusters = len(result.cluster_distribution)
-        try:
-            result.highdim_size = \
-                            len(f.column('highdim', map_f=json.loads).peek())
-        except ColumnNotFound:
-            result.highdim_size = None
-        try:
-            result.lowdim_size = \
-                            len(f.column('lowdim', map_f=json.loads).peek())
-        except ColumnNotFound:
-            result.lowdim_size = None
-        if 'skip_separation_metrics' in opts:
-            X, y = None, None
-        else:
-            try:
-                X, y = extract_X_y(f)
-            except ColumnNotFound:
-                X, y = None, None
-        if len(result.cluster_distribution) > 1 and X and y:
-            result.calinski_harabasz = calinski_harabasz(X, y)
-            result.davies_bouldin = davies_bouldin(X, y)
-            result.silhouette, result.silhouette_samples = \
-                                    silhouette(X, y, **silhouette_opts)
-        else:
-            result.calinski_harabasz = None
-            result.davies_bouldin = None
-            result.silhouette = None
-        if 'psq_pairs' in opts and result.clusters > 0:
-            result.psq_count = psq_count(f, opts['psq_pairs'])
-            if len(result.cluster_distribution) > 1:
-                result.psq_score, result.psq_score_zoom = \
-                                psq_score(result.psq_count,
-                                        result.cluster_distribution)
-            else:
-                result.psq_score, result.psq_score_zoom = None, None
-        else:
-            result.psq_count = None
-            result.psq_score, result.psq_score_zoom = None, None
-        if 'psq_pairs' in opts and not 'skip_psq_distance' in opts:
-            result.psq_distance = psq_distance(f, opts['psq_pairs'],
-                                                  **psq_distance_opts)
-            result.psq_distance_sample_size = \
-                                psq_distance_opts.get('sample_size', 1.)
-        else:
-            result.psq_distance, result.psq_distance_sample_size = None, None
+    if 'silhouette_approx' in opts and 'silhouette_simplified' in opts:
+        raise CliError('--silhouette-approx and --silhouette-simplified '
+                       'cannot be combined')
+    if 'silhouette_approx' in opts or 'silhouette_simplified' in opts:
+        silhouette_f = silhouette_approx if 'silhouette_approx' in opts \
+                       else silhouette_simplified
+        for k in ['sample_size', 'min_samples', 'max_samples']:
+            silhouette_opts.pop(k, None)
+        if silhouette_f == silhouette_simplified:
+            silhouette_opts.pop('chunk', None)
+    else:
+        silhouette_f = silhouette
+    def print_result(result: EvaluationResult, buf=None):
         if opts['format'] == 'text':
             _print_text(result)
-        elif opts['format'] == 'tsv':
-            _print_tsv(result)
         else:
-            raise CliError("Unknown FORMAT '{}'".format(opts['format']))
+            _print_tsv(result, buf=buf)
+    if opts['format'] == 'tsv': _print_tsv_header()
+    buf = StringIO()    # Included results are written all at once
+    for f in opts['include']:
+        for result in _parse_tsv(InputFile(f)):
+            print_result(result, buf=buf)
+    sys.stdout.write(buf.getvalue()); del buf
+    evaluate = partial(_evaluate_file, opts=opts, silhouette_f=silhouette_f,
+                       silhouette_opts=silhouette_opts,
+                       psq_distance_opts=psq_distance_opts)
+    if 'cache_dir' in opts:
+        evaluate = partial(_evaluate_file_cached, **evaluate.keywords,
+                           cache_dir=opts['cache_dir'],
+                           cache_params=_cache_params(opts, silhouette_f,
+                                        silhouette_opts, psq_distance_opts))
+    # Results are printed in the order of the FILE arguments either way
+    files = [ f for f in filenames if f != '-' ]
+    if jobs > 1 and len(files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        workers = min(jobs, len(files))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Worker processes cannot read the parent's stdin, so '-' is
+            # evaluated in this process while the workers are running
+            futures = { f: executor.submit(evaluate, f) for f in files }
+            for f in filenames:
+                print_result(evaluate(f) if f == '-' else futures[f].result())
+    else:
+        for result in map(evaluate, filenames):
+            print_result(result)
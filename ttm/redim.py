@@ -2,58 +2,237 @@
 
 from getopt import getopt, gnu_getopt
 from .types import *
-import sys, json
+import sys
 
 def id(vectors):
     return vectors
 
+def _row_major(matrix):
+    """
+    Make sure dense matrices are stored in C order, since all methods
+    below access their input row by row. Arrays that already are C
+    contiguous and sparse matrices are returned as they are.
+    """
+    from scipy.sparse import issparse
+    return matrix if issparse(matrix) else np.ascontiguousarray(matrix)
+
+_hnsw_spaces = { 'cosine': 'cosine', 'euclidean': 'l2', 'l2': 'l2' }
+
+def _hnsw_knn(matrix, neighbors, metric, jobs, min_rows=50000):
+    """
+    For large inputs, compute the kNN graph used by UMAP with an HNSW
+    index if hnswlib is installed, since building and querying the index
+    scales better than umap-learn's NN-descent. Returns the
+    (indices, distances, index) tuple expected by UMAP's precomputed_knn,
+    or (None, None, None) to let UMAP compute the graph itself.
+    """
+    from scipy.sparse import issparse
+    if matrix.shape[0] < min_rows or metric not in _hnsw_spaces \
+                                  or issparse(matrix):
+        return (None, None, None)
+    try:
+        import hnswlib
+    except ImportError:
+        return (None, None, None)
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    p = hnswlib.Index(space=_hnsw_spaces[metric], dim=matrix.shape[1])
+    p.init_index(max_elements=matrix.shape[0], ef_construction=200, M=16)
+    p.add_items(matrix, num_threads=jobs)
+    p.set_ef(max(neighbors*2, 50))
+    knn_idx, knn_dist = p.knn_query(matrix, k=neighbors, num_threads=jobs)
+    # hnswlib's l2 space yields squared euclidean distances
+    if _hnsw_spaces[metric] == 'l2': knn_dist = np.sqrt(knn_dist)
+    return (knn_idx.astype(np.int64), knn_dist, None)
+
+def _fast_umap(matrix, components, neighbors, metric, min_dist, jobs,
+               negative_samples=5, seed=0):
+    """
+    A stripped down version of UMAP that only computes the embedding.
+    The kNN graph is built with PyNNDescent and turned into a fuzzy
+    simplicial set as described by McInnes et al. (2018). The embedding
+    is initialized randomly rather than spectrally and optimized with a
+    numba-compiled negative sampling SGD loop.
+    """
+    from pynndescent import NNDescent
+    from scipy.optimize import curve_fit
+    from scipy.sparse import coo_matrix
+    import numba
+    n = matrix.shape[0]
+    knn_idx, knn_dist = NNDescent(matrix, n_neighbors=neighbors,
+                                  metric=metric, random_state=seed,
+                                  n_jobs=jobs).neighbor_graph
+    # Local connectivity: the nearest neighbor of each point has weight 1
+    # and sigma is chosen so that the weights sum up to log2(neighbors).
+    d = knn_dist[:,1:].astype(np.float64)
+    rho = np.where(d > 0, d, np.inf).min(axis=1)
+    rho[np.isinf(rho)] = 0
+    d = np.maximum(d - rho[:,None], 0)
+    target = np.log2(neighbors)
+    lo, hi, sigma = np.zeros(n), np.full(n, np.inf), np.ones(n)
+    for _ in range(64):
+        too_big = np.exp(-d / sigma[:,None]).sum(axis=1) > target
+        hi = np.where(too_big, sigma, hi)
+        lo = np.where(too_big, lo, sigma)
+        sigma = np.where(np.isinf(hi), sigma*2, (lo + hi) / 2)
+    sigma = np.maximum(sigma, 1e-3 * knn_dist.mean(axis=1))
+    weights = np.exp(-np.maximum(knn_dist - rho[:,None], 0) / sigma[:,None])
+    P = coo_matrix((weights.ravel(), (np.repeat(np.arange(n), neighbors),
+                    knn_idx.ravel())), shape=(n, n)).tocsr()
+    P.setdiag(0); P.eliminate_zeros()
+    P = (P + P.T - P.multiply(P.T)).tocoo()
+    # Fit the a and b parameters of the low dimensional similarity curve
+    x = np.linspace(0, 3, 300)
+    y = np.where(x < min_dist, 1, np.exp(-(x - min_dist)))
+    (a, b), _ = curve_fit(lambda x, a, b: 1 / (1 + a*x**(2*b)), x, y)
+    epochs = 500 if n <= 10000 else 200
+    keep = P.data >= P.data.max() / epochs
+    head, tail = P.row[keep], P.col[keep]
+    epochs_per_sample = P.data.max() / P.data[keep]
+    @numba.njit(parallel=True, fastmath=True)
+    def optimize(Y, head, tail, epochs_per_sample, a, b, epochs, n_neg):
+        next_sample = epochs_per_sample.copy()
+        for epoch in range(epochs):
+            alpha = 1 - epoch / epochs
+            for e in numba.prange(len(head)):
+                if next_sample[e] > epoch: continue
+                i, j = head[e], tail[e]
+                d2 = np.sum((Y[i] - Y[j])**2)
+                if d2 > 0:
+                    coeff = -2*a*b * d2**(b-1) / (a * d2**b + 1)
+                    for k in range(Y.shape[1]):
+                        g = max(-4., min(4., coeff * (Y[i,k] - Y[j,k])))
+                        Y[i,k] += alpha * g
+                        Y[j,k] -= alpha * g
+                for _ in range(n_neg):
+                    j = np.random.randint(Y.shape[0])
+                    if j == i: continue
+                    d2 = np.sum((Y[i] - Y[j])**2)
+                    coeff = 2*b / ((.001 + d2) * (a * d2**b + 1))
+                    for k in range(Y.shape[1]):
+                        g = 4. if d2 == 0 else \
+                            max(-4., min(4., coeff * (Y[i,k] - Y[j,k])))
+                        Y[i,k] += alpha * g
+                next_sample[e] += epochs_per_sample[e]
+        return Y
+    Y = np.random.default_rng(seed).uniform(-10, 10, (n, components))
+    # numba uses its own thread pool, which threadpool_limits does not
+    # cover, so the number of jobs is applied to it explicitly
+    threads = numba.get_num_threads()
+    if jobs > 0:
+        numba.set_num_threads(min(jobs, numba.config.NUMBA_NUM_THREADS))
+    try:
+        return optimize(Y.astype(np.float32), head, tail, epochs_per_sample,
+                        np.float32(a), np.float32(b), epochs,
+                        negative_samples)
+    finally:
+        numba.set_num_threads(threads)
+
+def _cuml_available():
+    try:
+        import cuml, cupy
+        return True
+    except ImportError:
+        return False
+
+def _to_gpu(matrix):
+    """
+    Copy a matrix to GPU memory as float32, which is the only type for
+    which cuML uses fast GPU kernels throughout.
+    """
+    import cupy as cp
+    from scipy.sparse import issparse
+    if issparse(matrix):
+        import cupyx.scipy.sparse
+        return cupyx.scipy.sparse.csr_matrix(matrix.astype(np.float32))
+    return cp.asarray(matrix, dtype=cp.float32)
+
 def umap(vectors, components=5, neighbors=15, metric='cosine',
-                  min_dist=.1):
-    from umap import UMAP
+                  min_dist=.1, jobs=-1, fast=False, dtype=None, gpu=False):
     print('Applying UMAP ...', end='', file=sys.stderr, flush=True)
+    if gpu:
+        from cuml.manifold import UMAP as cuUMAP
+        import cupy as cp
+        result = cuUMAP(
+            n_neighbors = neighbors,
+            n_components = components,
+            metric = metric,
+            min_dist = min_dist,
+        ).fit_transform(_to_gpu(vectors.matrix(dtype=dtype)))
+        print(' done', end='\n', file=sys.stderr, flush=True)
+        return cp.asnumpy(result)
+    if fast:
+        result = _fast_umap(_row_major(vectors.matrix(dtype=dtype)),
+                            components, neighbors, metric, min_dist, jobs)
+        print(' done', end='\n', file=sys.stderr, flush=True)
+        return result
+    from umap import UMAP
+    matrix = _row_major(vectors.matrix(dtype=dtype))
     result = UMAP(
         n_neighbors = neighbors,
         n_components = components,
         metric = metric,
         min_dist = min_dist,
-    ).fit(vectors.matrix())
+        n_jobs = jobs,
+        precomputed_knn = _hnsw_knn(matrix, neighbors, metric, jobs),
+    ).fit(matrix)
     print(' done', end='\n', file=sys.stderr, flush=True)
-    return result.embedding_.tolist()
+    return result.embedding_
 
-def lda(vectors, components=5, max_epochs=10, shift=False):
+def lda(vectors, components=5, max_epochs=10, shift=False,
+        learning=None, batch_size=128, dtype=None):
     from sklearn.decomposition import LatentDirichletAllocation
     import numpy as np
-    matrix = vectors.matrix()
+    from scipy.sparse import issparse
+    matrix = _row_major(vectors.matrix(dtype=dtype))
     if shift:
-        rows, cols = matrix.shape
-        for c in range(cols):
-            colmin = matrix[:,c].min()
-            if colmin >= 0:
-                print(f'\rSkipping column {c+1}/{cols} ...',
-                      end='', file=sys.stderr, flush=True)
-            else:
-                print(f'\rShifting column {c+1}/{cols} ...',
-                      end='', file=sys.stderr, flush=True)
-                for r in range(rows):
-                    matrix[r,c] -= colmin
+        colmins = matrix.min(axis=0)
+        if issparse(colmins): colmins = colmins.toarray()
+        colmins = np.asarray(colmins).ravel()
+        negative = colmins < 0
+        print(f'Shifting {negative.sum()}/{len(colmins)} columns ...',
+              end='', file=sys.stderr, flush=True)
+        if negative.any():
+            # Shifting turns the zeros of a sparse matrix into non-zeros
+            if issparse(matrix): matrix = matrix.toarray()
+            matrix -= np.where(negative, colmins, 0).astype(matrix.dtype)
         print(' done', end='\n', file=sys.stderr, flush=True)
+    if learning is None:
+        learning = 'online' if matrix.shape[0] > 10000 else 'batch'
     print('Applying LDA ...', end='', file=sys.stderr, flush=True)
     result = LatentDirichletAllocation(
             max_iter=max_epochs,
             n_components=components,
+            learning_method=learning,
+            batch_size=batch_size,
         ).fit_transform(matrix)
     print(' done', end='\n', file=sys.stderr, flush=True)
-    return result.tolist()
+    return result
 
-def svd(vectors, components=5):
-    from sklearn.decomposition import TruncatedSVD
+def svd(vectors, components=5, algorithm='arpack', dtype=float, gpu=False):
     print('Applying SVD ...', end='', file=sys.stderr, flush=True)
+    if gpu:
+        from cuml.decomposition import TruncatedSVD as cuTruncatedSVD
+        from scipy.sparse import issparse
+        import cupy as cp
+        matrix = vectors.matrix(dtype=dtype)
+        # cuML's TruncatedSVD only supports dense input
+        if issparse(matrix): matrix = matrix.toarray()
+        result = cuTruncatedSVD(
+                n_components = components,
+                algorithm = 'jacobi',
+                random_state = 0,
+            ).fit_transform(_to_gpu(matrix))
+        print(' done', end='\n', file=sys.stderr, flush=True)
+        return cp.asnumpy(result)
+    from sklearn.decomposition import TruncatedSVD
     result = TruncatedSVD(
             n_components = components,
-            algorithm = 'arpack',   # Should produce deterministic results
-        ).fit_transform(vectors.matrix(dtype=float))
+            algorithm = algorithm,
+            n_iter = 5,
+            random_state = 0,       # Both algorithms are deterministic
+        ).fit_transform(_row_major(vectors.matrix(dtype=dtype)))
     print(' done', end='\n', file=sys.stderr, flush=True)
-    return result.tolist()
+    return result
 
 _cli_help="""
 Usage: ttm [OPT]... redim [COMMAND-OPTION]... METHOD [ARG]...
@@ -83,12 +262,49 @@ Command Options
             top of one another.
     -C COLUMN, --output-column COLUMN
             Rather than 'lowdim', use COLUMN as the output column name.
+    -t N, --threads N
+            Limit the number of threads used by the BLAS and OpenMP
+            libraries underlying numpy and sklearn (and the number of
+            parallel jobs used by 'umap') to N. By default, these
+            libraries use all CPUs, which can be slower than using fewer
+            threads if other programs are running at the same time.
+    --dtype DTYPE
+            Either 'float32' or 'float64'. Convert the input vectors to
+            DTYPE before passing them to 'svd', 'lda' or 'umap'. Using
+            float32 halves the memory needed for the input matrix and is
+            usually faster, but may cause small numerical differences in
+            the results. By default, 'svd' uses float64, while 'lda' and
+            'umap' use the type of the values found in the input column.
+    --gpu
+            Run 'svd' or 'umap' on a CUDA capable GPU using the cuML
+            implementations of these methods. The input vectors are
+            converted to float32 and copied to GPU memory; sparse input
+            is converted to a dense matrix for 'svd'. cuML's results are
+            similar, but not identical to those computed on the CPU. If
+            cuML is not installed, a warning is printed and the CPU
+            implementation is used instead.
+    --store-npy
+            In addition to the json-serialized vectors in the output
+            file, store a binary float32 copy of these vectors in a
+            file named like the output file, but with '.COLUMN.npy'
+            appended (e. g. 'result.tsv.lowdim.npy'). 'ttm eval' uses
+            this file instead of parsing the json-serialized vectors if
+            it is found next to the file being evaluated and matches its
+            contents. This option requires the output file to be
+            specified via the '-o' option.
     -h, --help
             Print this help message and exit.
 
 Arguments for 'svd'
     --components N      Number of dimensions in the 'lowdim' vector.
                         Default: 5.
+    --algorithm ALG     Either 'arpack' or 'randomized'. The randomized
+                        solver by Halko et al. computes the decomposition
+                        from a small random projection of the data and is
+                        typically several times faster on large inputs,
+                        but only approximates the ARPACK result. A fixed
+                        random seed is used, so results are reproducible
+                        with either algorithm. Default: 'arpack'.
 
 Arguments for 'lda'
     --components N      Number of dimensions in the 'lowdim' vector.
@@ -103,6 +319,15 @@ Arguments for 'lda'
                         shifted upwards, so that the lowest entry has a
                         value of zero. All entries in any given column
                         are shifted upwards by the same amount.
+    --learning METHOD   Either 'batch' or 'online'. Batch learning uses
+                        all documents in every update, while online
+                        learning updates the model after each mini-batch
+                        of documents. Online learning usually needs fewer
+                        passes over large corpora. Default: 'online'
+                        for inputs with more than 10000 documents,
+                        'batch' otherwise.
+    --batch-size N      Number of documents in each mini-batch when using
+                        online learning. Default: 128.
 
 Arguments for 'umap'
     --components N      Number of dimensions in the 'lowdim' vector.
@@ -117,19 +342,30 @@ Arguments for 'umap'
                         Default: 'cosine'.
     --min-dist N        Minimum distance between points in 'lowdim'. See
                         'pydoc umap.UMAP' for more details. Default: 0.1.
+    --fast              Rather than umap-learn's full implementation, use
+                        a stripped down version that builds the kNN graph
+                        with PyNNDescent, starts from a random rather than
+                        a spectral initialization and optimizes the
+                        embedding with a compact numba-compiled SGD loop.
+                        This is considerably faster, but the results are
+                        not identical to those of umap-learn.
 """.lstrip()
 
 def _cli(argv, infile, outfile):
-    opts, args = getopt(argv, 'c:C:h', ['input-column=', 'output-column=',
-                                        'help'])
+    opts, args = getopt(argv, 'c:C:t:h', ['input-column=', 'output-column=',
+                                          'help', 'store-npy', 'threads=',
+                                          'dtype=', 'gpu'])
     short2long = { '-c': '--input-column', '-C': '--output-column',
-                   '-h': '--help' }
+                   '-t': '--threads', '-h': '--help' }
     opts = { short2long.get(k, k).lstrip('-').replace('-', '_'): v
              for k, v in opts }
     if 'help' in opts:
         raise HelpRequested(_cli_help)
     elif len(args) == 0:
         raise CliError('No METHOD specified for ttm redim')
+    if 'store_npy' in opts and outfile.filename == '-':
+        raise CliError('--store-npy requires the output file to be '
+                       "specified via '-o'")
     def fail_on_rest(rest):
         if rest:
             rest = ' '.join(rest)
@@ -138,24 +374,35 @@ def _cli(argv, infile, outfile):
         fail_on_rest(args[1:])
         method, method_args = id, {}
     elif args[0] == 'svd':
-        svd_opts, rest = gnu_getopt(args[1:], '', ['components='])
+        svd_opts, rest = gnu_getopt(args[1:], '', ['components=',
+                                                   'algorithm='])
         fail_on_rest(rest)
-        svd_opts = { k.lstrip('-'): int(v) for k, v in svd_opts }
+        svd_opts = { k.lstrip('-'): v for k, v in svd_opts }
+        if 'components' in svd_opts:
+            svd_opts['components'] = int(svd_opts['components'])
+        if svd_opts.get('algorithm', 'arpack') not in ['arpack',
+                                                       'randomized']:
+            raise CliError(f"Unknown svd algorithm '{svd_opts['algorithm']}'")
         method, method_args = svd, svd_opts
     elif args[0] == 'lda':
         lda_opts, rest = gnu_getopt(args[1:], '', ['components=',
-                                    'max-epochs=', 'shift'])
+                                    'max-epochs=', 'shift', 'learning=',
+                                    'batch-size='])
         fail_on_rest(rest)
         lda_opts = { k.lstrip('-').replace('-', '_'): v
                      for k, v in lda_opts }
-        for k in ['components', 'max_epochs']:
-            if k in lda_opts: lda_opts[k] = int(v)
+        for k in ['components', 'max_epochs', 'batch_size']:
+            if k in lda_opts: lda_opts[k] = int(lda_opts[k])
         for k in ['shift']:
             if k in lda_opts: lda_opts[k] = True
+        if lda_opts.get('learning', 'batch') not in ['batch', 'online']:
+            raise CliError('Unknown lda learning METHOD '
+                          f"'{lda_opts['learning']}'")
         method, method_args = lda, lda_opts
     elif args[0] == 'umap':
         umap_opts, rest = gnu_getopt(args[1:], '', ['components=',
-                                     'neighbors=', 'metric=', 'min-dist='])
+                                     'neighbors=', 'metric=', 'min-dist=',
+                                     'fast'])
         fail_on_rest(rest)
         umap_opts = { k.lstrip('-').replace('-', '_'): v
                       for k, v in umap_opts }
@@ -163,17 +410,52 @@ def _cli(argv, infile, outfile):
             if k in umap_opts: umap_opts[k] = int(umap_opts[k])
         for k in ['min_dist']:
             if k in umap_opts: umap_opts[k] = float(umap_opts[k])
+        for k in ['fast']:
+            if k in umap_opts: umap_opts[k] = True
         method, method_args = umap, umap_opts
     else:
         raise CliError(f"Unknown ttm redim METHOD '{args[0]}'")
+    if 'dtype' in opts:
+        if opts['dtype'] not in ['float32', 'float64']:
+            raise CliError(f"Unsupported --dtype '{opts['dtype']}'")
+        if method != id: method_args['dtype'] = np.dtype(opts['dtype'])
+    if 'gpu' in opts:
+        if method not in [svd, umap]:
+            raise CliError("--gpu is only supported for 'svd' and 'umap'")
+        elif _cuml_available():
+            method_args['gpu'] = True
+        else:
+            print('Warning: --gpu requires cuML, which is not installed. '
+                  'Falling back to the CPU.', file=sys.stderr)
     # Apply dimensionality reduction
     incol = opts.get('input_column', 'highdim')
     outcol = opts.get('output_column', 'lowdim')
-    highdim = infile.column(incol, map_f=json.loads)
-    lowdim = method(highdim, **method_args)
+    highdim = infile.column(incol, map_f=json_loads)
+    if 'threads' in opts:
+        from threadpoolctl import threadpool_limits
+        threads = int(opts['threads'])
+        if threads < 1: raise CliError('--threads must be a positive integer')
+        if method == umap: method_args['jobs'] = threads
+        with threadpool_limits(limits=threads):
+            lowdim = method(highdim, **method_args)
+    else:
+        lowdim = method(highdim, **method_args)
+    if isinstance(lowdim, np.ndarray):
+        # Rows are serialized one by one, so they need to be contiguous
+        lowdim = np.ascontiguousarray(lowdim)
     # Copy result into outfile
     infile.ensure_loaded()
     input_lines = iter(infile.strip(outcol))
-    print(f'{next(input_lines)}\t{outcol}', file=outfile)
-    for line, v in zip(input_lines, lowdim):
-        print(f'{line}\t{json.dumps(v)}', file=outfile)
+    # Input lines are streamed and paired with the rows of lowdim by
+    # position, so no second copy of the corpus is held in memory. The
+    # buffered output file consumes the generator in a single call.
+    outfile.write(f'{next(input_lines)}\t{outcol}\n')
+    outfile.writelines(f'{line}\t{json_dumps(v)}\n'
+                       for line, v in zip(input_lines, lowdim))
+    if 'store_npy' in opts:
+        # The output file is closed first, so the sidecar is never older
+        # than the tsv file it belongs to
+        outfile.close()
+        np.save(npy_sidecar(outfile.filename, outcol),
+                np.asarray(lowdim if isinstance(lowdim, np.ndarray)
+                           else list(lowdim), dtype=np.float32))
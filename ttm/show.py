@@ -4,37 +4,34 @@ from getopt import getopt, gnu_getopt
 from .types import *
 from .eval import cluster_distribution
 
-def book(infile: InputFile, cluster_order: list, book: str, res=30) -> str:
-    infile.ensure_loaded()
-    page_clusters = dict()
-    for doc, c in zip(infile.column('id'), infile.column('cluster')):
-        b, p = doc.split(':'); p=int(p)
-        if b != book: continue
-        page_clusters[p] = c
-    cluster_freq = { c: 0 for c in set(page_clusters.values()) }
-    for p, c in page_clusters.items():
-        cluster_freq[c] += 1
+_glyphs = ( '   ', ' - ', ' + ', '-+ ', '-+-', '++-', '+++' )
+
+def book(book_pages: dict, cluster_order: list, book: str,
+         res=30) -> str:
+    """
+    Render the clusters found in the pages of a single book. book_pages
+    maps the name of each book to a dict, which in turn maps the book's
+    page numbers to their clusters (see _book_pages). This index is only
+    built once if multiple books are rendered, and each book can then be
+    rendered without looking at the pages of any other book.
+    """
+    page_clusters = book_pages.get(book, {})
     header = f'  {"":>9}   ' + \
                 ''.join([f'{c[:2]:>2} ' for c in cluster_order])
     result = [ header ]
     pages = sorted(page_clusters.keys())
-    while pages:
-        fst, lst = None, None
-        clusters_found = { c: 0 for c in cluster_order }
-        for i in range(min(len(pages), res)):
-            p = pages.pop(0)
-            if fst == None: fst = p
-            clusters_found[page_clusters[p]] += 1
-        lst = p
+    cluster_index = { c: i for i, c in enumerate(cluster_order) }
+    page_cluster_index = np.fromiter((cluster_index[page_clusters[p]]
+                                      for p in pages), dtype=np.int64,
+                                     count=len(pages))
+    for start in range(0, len(pages), res):
+        fst, lst = pages[start], pages[min(start+res, len(pages))-1]
+        clusters_found = np.bincount(page_cluster_index[start:start+res],
+                                     minlength=len(cluster_order))
+        # Glyph i is used for up to i/6 of the res pages in a line
+        glyphs = np.minimum(6, -(-clusters_found*6 // res))
         line = [ f'  {str(fst)+"-"+str(lst):>9}  |' ]
-        for c in cluster_order:
-            if clusters_found[c]/res == 0:     line.append('   ')
-            elif clusters_found[c]/res <= 1/6: line.append(' - ')
-            elif clusters_found[c]/res <= 2/6: line.append(' + ')
-            elif clusters_found[c]/res <= 3/6: line.append('-+ ')
-            elif clusters_found[c]/res <= 4/6: line.append('-+-')
-            elif clusters_found[c]/res <= 5/6: line.append('++-')
-            else:                              line.append('+++')
+        line.extend(_glyphs[g] for g in glyphs)
         result.append(''.join(line)+'|')
     result.append(header)
     return '\n'.join(result)
@@ -53,30 +50,33 @@ def clusters(clusters) -> str:
     else:
         raise Exception("Argument 'clusters' must be of type 'Column' or "
                        f"'dict', not '{type(clusters)}'")
-    w_cluster = max(9, max([len(str(x)) for x in csize.keys()]))
-    w_pages = max(8, max([len(str(x)) for x in csize.values()]))
+    keys = list(csize)
+    sizes = np.fromiter(csize.values(), dtype=np.int64, count=len(keys))
+    w_cluster = max(9, max(map(len, map(str, keys))))
+    w_pages = max(8, len(str(sizes.max())))
     t.append(f'  {"Cluster".rjust(w_cluster)}   {"Pages".rjust(w_pages)}'
              f'   {"Size (%)".rjust(9)}   Histogram')
     t.append(f'  {w_cluster*"-"}   {w_pages*"-"}   {9*"-"}   {35*"-"}--')
-    total = sum(csize.values())
-    histscale = 35/(max(csize.values())/total)
-    for c in sorted(csize, key=lambda c: csize[c], reverse=True):
-        relsize = csize[c]/total
-        t.append(f'  {str(c).rjust(w_cluster)}'
-                 f'   {str(csize[c]).rjust(w_pages)}   {100*relsize:9.2f}'
-                  '   ' + round(relsize*histscale)*'*')
+    total = int(sizes.sum())
+    relsizes = sizes / total
+    bars = np.rint(relsizes * (35/(sizes.max()/total))).astype(int)
+    for i in np.argsort(-sizes, kind='stable'):
+        t.append(f'  {str(keys[i]).rjust(w_cluster)}'
+                 f'   {str(sizes[i]).rjust(w_pages)}'
+                 f'   {100*relsizes[i]:9.2f}   ' + bars[i]*'*')
     return '\n'.join(t)
 
 def desc(infile, clusters=None) -> dict:
     cdesc = { c: None for c in clusters }
-    infile.ensure_loaded()
-    for cluster, tfidf_words, pure_docs in zip(
-                infile.column('cluster'), infile.column('tfidf_words'),
-                infile.column('pure_docs')):
+    remaining = len(cdesc)
+    if remaining == 0: return cdesc
+    rows = infile.columns([ 'cluster', 'tfidf_words', 'pure_docs' ])
+    for cluster, tfidf_words, pure_docs in rows:
         if cdesc[cluster] == None:
             cdesc[cluster] = { 'tfidf_words': tfidf_words,
                                'pure_docs': pure_docs }
-        if None not in cdesc.values(): break
+            remaining -= 1
+            if remaining == 0: break
     return cdesc
 
 _cli_help="""
@@ -99,14 +99,35 @@ Subcommands
         print them to stdout in markdown format.
 """.lstrip()
 
-def _book_filter(infile: InputFile, bookexp: list):
+def _book_filter(ids, bookexp: list):
+    """
+    Yield the names of all books matching at least one of the regular
+    expressions in bookexp; first all books matching the first expression,
+    then those matching the second one, etc. Each book is yielded once.
+    Every book is only tested against the expressions up to the first
+    one it matches.
+    """
     import re
-    all_books = { d.split(':')[0] for d in infile.column('id') }
-    for exp in bookexp:
-        for b in sorted(all_books):
-            if re.search(exp, b):
-                all_books.remove(b)
-                yield b
+    patterns = [ re.compile(exp) for exp in bookexp ]
+    matches = []
+    for b in sorted({ d.split(':', 1)[0] for d in ids }):
+        for i, pattern in enumerate(patterns):
+            if pattern.search(b):
+                matches.append((i, b))
+                break
+    # The sort is stable, so books remain sorted within each expression
+    matches.sort(key=lambda m: m[0])
+    for _, b in matches: yield b
+
+def _book_pages(ids, clusters) -> dict:
+    """
+    Map each book name to a dict mapping page numbers to clusters.
+    """
+    book_pages = {}
+    for d, c in zip(ids, clusters):
+        b, p = d.split(':')
+        book_pages.setdefault(b, {})[int(p)] = c
+    return book_pages
 
 def _book(argv, infile):
     from textwrap import fill, indent
@@ -115,29 +136,37 @@ def _book(argv, infile):
     opts = { k.lstrip('-'): int(v) for k, v in opts }
     if len(bookexp) == 0:
         raise CliError("No REGEX specified for 'ttm show book'")
-    cluster_dist = cluster_distribution(infile.column('cluster'))
+    infile.ensure_loaded()
+    ids = list(infile.column('id'))
+    clusters = list(infile.column('cluster'))
+    book_pages = _book_pages(ids, clusters)
+    cluster_dist = cluster_distribution(clusters)
     cluster_order = [ c for _, c in sorted([(f, c) for c, f
                         in cluster_dist.items()], reverse=True) ]
     blocks = []
-    for b in _book_filter(infile, bookexp):
-        graph = book(infile, cluster_order, b, res=opts.get('res', 30))
+    for b in _book_filter(ids, bookexp):
+        graph = book(book_pages, cluster_order, b,
+                     res=opts.get('res', 30))
         title = indent(fill(b, width=37), '  ')
         blocks.append(f'{title}\n\n{graph}\n\n\n')
-    full_length = sum([ len(b.splitlines()) for b in blocks ])
+    heights = [ b.count('\n') for b in blocks ]
+    full_length = sum(heights)
     max_line = max((max(map(len, b.splitlines())) for b in blocks))
     col_width = max(40, max_line)
     n_cols = opts.get('cols', (get_terminal_size().columns+1) // col_width)
     cols = [ [] for _ in range(n_cols) ]
-    blocks_length = 0; i = 0; n = 0
-    while i < len(blocks):
-        blocks_length += len(blocks[i].splitlines()); i+=1
+    blocks_length = 0; start = 0; i = 0; n = 0
+    while i < len(blocks) and n < n_cols - 1:
+        blocks_length += heights[i]; i+=1
         if blocks_length >= full_length / n_cols:
-            cols[n], blocks = blocks[:i], blocks[i:]
-            lastlen = len(cols[n][-1].splitlines())
-            if blocks and blocks_length - lastlen/2 > full_length / n_cols:
-                blocks.insert(0, cols[n].pop())
-            blocks_length = 0; i = 0; n+=1
-    if blocks: cols[-1].extend(blocks)      # Catch trailing block
+            # Move the last block to the next column if more than half
+            # of it exceeds this column's share of the full length
+            if i < len(blocks) and i-1 > start and \
+                    blocks_length - heights[i-1]/2 > full_length / n_cols:
+                i -= 1
+            cols[n] = blocks[start:i]
+            blocks_length = 0; start = i; n+=1
+    cols[-1].extend(blocks[start:])         # Catch trailing blocks
     cols = [ ''.join(c).splitlines() for c in cols ]
     print()
     for i in range(max(map(len, cols))):
@@ -149,9 +178,10 @@ def _book(argv, infile):
 def _clusters(argv, infile):
     from textwrap import fill, indent
     if argv:
-        books = list(_book_filter(infile, argv))
+        books = list(_book_filter(infile.column('id'), argv))
+        book_set = frozenset(books)
         col = infile.column('cluster').filter('id',
-                                        lambda x: x.split(':')[0] in books)
+                                lambda x: x.split(':', 1)[0] in book_set)
         cap0 = 'Overview of clusters and cluster sizes in ' \
               f'`{infile.filename}` for '
         if len(books) == 0:
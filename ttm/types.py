@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 
-import sys, gzip, bz2, lzma
+import sys, os, io, gzip, bz2, lzma, subprocess, shutil, json
 import numpy as np
+from operator import itemgetter
+from itertools import islice, chain
+from array import array
 from scipy.sparse import csr_matrix
 
+# orjson is considerably faster at parsing and serializing the json-encoded
+# vectors stored in the tsv files, but it is optional. If it is not
+# installed, the json module from the standard library is used instead.
+# Both variants of json_dumps also accept numpy arrays.
+try:
+    from orjson import loads as json_loads, dumps as _orjson_dumps
+    from orjson import OPT_SERIALIZE_NUMPY as _OPT_SERIALIZE_NUMPY
+    def json_dumps(obj) -> str:
+        return _orjson_dumps(obj, option=_OPT_SERIALIZE_NUMPY).decode()
+except ImportError:
+    from json import loads as json_loads, dumps as _json_dumps
+    def json_dumps(obj) -> str:
+        if isinstance(obj, np.ndarray): obj = obj.tolist()
+        return _json_dumps(obj)
+
 class HelpRequested(Exception):
     pass
 class CliError(Exception):
@@ -15,11 +33,61 @@ class ColumnNotFound(Exception):
 class EmptyColumnError(Exception):
     pass
 
+_io_buffer_size = 1 << 18
+
+# Compression module used for each supported file extension
+_compression = { '.gz': gzip, '.bz2': bz2, '.xz': lzma }
+
+# External decompression programs, in order of preference. These run in
+# a separate process (and, in the case of pigz and lbzip2, on several
+# cores), so decompression overlaps with parsing the decompressed lines.
+_decompressors = {
+    '.gz':  [ ['pigz', '-dc'], ['gzip', '-dc'] ],
+    '.bz2': [ ['lbzip2', '-dc'], ['bzip2', '-dc'] ],
+    '.xz':  [ ['xz', '-T0', '-dc'] ],
+}
+
+_multicore = (os.cpu_count() or 1) > 1
+_pipe_size = 1 << 20
+
+class _DecompressingPipe(io.TextIOWrapper):
+    """
+    Text stream reading the output of an external decompression program.
+    Closing the stream waits for the program to terminate and raises an
+    ExpectedRuntimeError if it failed.
+    """
+    def __init__(self, cmd, filename):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"No such file: '{filename}'")
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd + [filename],
+                                      stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.PIPE,
+                                      bufsize=_io_buffer_size)
+        try:
+            # Linux allows to enlarge the pipe, so that the decompression
+            # program can run further ahead of the parsing of its output
+            import fcntl
+            fcntl.fcntl(self._proc.stdout,
+                        getattr(fcntl, 'F_SETPIPE_SZ', 1031), _pipe_size)
+        except (ImportError, OSError):
+            pass
+        super().__init__(self._proc.stdout)
+    def close(self):
+        if self.closed: return
+        super().close()
+        # A negative return code means the program was terminated by a
+        # signal, e. g. by SIGPIPE if the stream was closed early
+        if self._proc.wait() > 0:
+            raise ExpectedRuntimeError(f"'{' '.join(self._cmd)}' failed "
+                                  f'with exit code {self._proc.returncode}')
+
 def _open(filename, direction):
     """
     Wrapper around a number of file opening functions that takes the
     filename into account to handle automagic on the file compression
-    if the filename ends in '.gz', '.bz2', or '.xz'.
+    if the filename ends in '.gz', '.bz2', or '.xz'. Compressed input is
+    decompressed by an external program if one is available.
     """
     if direction not in ['in','out']:
         raise Exception("Direction must be one of 'in' or 'out', "\
@@ -27,14 +95,30 @@ def _open(filename, direction):
     mode = 'rt' if direction == 'in' else 'wt'
     if filename == '-':
         return sys.stdin if direction == 'in' else sys.stdout
-    elif filename.endswith('.gz'):
-        return gzip.open(filename, mode)
-    elif filename.endswith('.bz2'):
-        return bz2.open(filename, mode)
-    elif filename.endswith('.xz'):
-        return lzma.open(filename, mode)
-    else:
+    ext = os.path.splitext(filename)[1]
+    module = _compression.get(ext)
+    if module is None:
         return open(filename, mode)
+    elif direction == 'out':
+        return module.open(filename, mode)
+    # The external programs only pay off if they get a core of their own
+    for cmd in _decompressors[ext] if _multicore else []:
+        if shutil.which(cmd[0]): return _DecompressingPipe(cmd, filename)
+    # Decompress large chunks at once rather than small pieces for every
+    # few lines
+    f = io.BufferedReader(module.open(filename, 'rb'),
+                          buffer_size=_io_buffer_size)
+    return io.TextIOWrapper(f)
+
+def npy_sidecar(filename: str, column: str) -> str:
+    """
+    Return the name of the .npy file which may hold a binary copy of the
+    vectors stored in the specified column of a tsv file. Such sidecar
+    files are written by 'ttm redim --store-npy'. The tsv file itself
+    remains authoritative; the sidecar is a cache that allows to load the
+    vectors without parsing any json.
+    """
+    return f'{filename}.{column}.npy'
 
 class OutputFile():
     """
@@ -43,9 +127,14 @@ class OutputFile():
     with '.gz', '.bz2', or '.xz'.
     """
     def __init__(self, filename):
+        self.filename = filename
         self.file = _open(filename, 'out')
     def write(self, content):
         return self.file.write(content)
+    def writelines(self, lines):
+        return self.file.writelines(lines)
+    def close(self):
+        if self.file is not sys.stdout: self.file.close()
 
 class CachingFileReader():
     """
@@ -61,29 +150,41 @@ class CachingFileReader():
     decompression if the filename ends with '.gz', '.bz2', or '.xz'.
     """
     def __init__(self, filename):
-        self.cache = list()
+        # The cache holds all lines utf-8 encoded in a single buffer, with
+        # the offset at which each line starts. This needs much less memory
+        # than one str object per line. Lines are encoded with the
+        # surrogateescape error handler, which stdin uses for undecodable
+        # bytes in the C locale and in utf-8 mode, so such lines round-trip.
+        self.cache = io.BytesIO()
+        self.cache_offsets = array('q', [0])
         self.cache_complete = False
         self.filename = filename
         self.file_accessed = False
         self._len = None
-        self.f = _open(filename, 'in')
-        self.regular_file = self.f != sys.stdin and self.f.seekable()
-        if self.regular_file: self.f.close()
+        # Regular files are reopened for every iteration. This also holds
+        # for compressed files, even if they are read through a pipe.
+        self.regular_file = filename != '-' and os.path.isfile(filename)
+        if not self.regular_file: self.f = _open(filename, 'in')
     def __iter__(self):
         if self.regular_file:
             with _open(self.filename, 'in') as f:
                 for line in f:
-                    line = line.rstrip('\n').rstrip('\r')
-                    yield line
+                    yield line.rstrip('\r\n')
         elif self.cache_complete:
-            for line in self.cache:
-                yield line
+            data, offsets = self.cache, self.cache_offsets
+            for i in range(len(offsets)-1):
+                yield data[offsets[i]:offsets[i+1]-1].decode(
+                                        'utf-8', 'surrogateescape')
         elif not self.file_accessed:
             self.file_accessed = True
+            write, offset = self.cache.write, 0
             for line in self.f:
-                line = line.rstrip('\n').rstrip('\r')
-                self.cache.append(line)
+                line = line.rstrip('\r\n')
+                offset += write(line.encode('utf-8', 'surrogateescape')
+                                + b'\n')
+                self.cache_offsets.append(offset)
                 yield line
+            self.cache = self.cache.getvalue()
             self.cache_complete = True
         else:
             raise Exception('Second iteration over input started before '\
@@ -91,9 +192,26 @@ class CachingFileReader():
     def ensure_loaded(self):
         _ = len(self)   # len iterates over all lines (unless it already has)
     def __len__(self):
+        if self._len == None and self.regular_file:
+            self._len = _count_lines(self.filename)
         if self._len == None: self._len = sum((1 for _ in self))
         return self._len
 
+def _count_lines(filename):
+    """
+    Count the lines in an uncompressed file without decoding it. Returns
+    None for compressed files and for files containing carriage returns,
+    since those may end lines on their own when decoding the file.
+    """
+    if os.path.splitext(filename)[1] in _compression: return None
+    n, last = 0, b'\n'
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(_io_buffer_size), b''):
+            if b'\r' in chunk: return None
+            n += chunk.count(b'\n')
+            last = chunk[-1:]
+    return n if last == b'\n' else n + 1
+
 class InputFile():
     """
     Iterable over all lines in a tsv file. If strip_columns (list of strings)
@@ -106,6 +224,8 @@ class InputFile():
         else:
             self.file_reader = CachingFileReader(filename)
         self.strip_columns = strip_columns
+        self._id_index = None
+        self._header_index = None
     @property
     def filename(self):
         return self.file_reader.filename
@@ -119,12 +239,19 @@ class InputFile():
                 header = next(lines).split('\t')
             except StopIteration as e:
                 raise ExpectedRuntimeError('Input file is empty') from e
-            yield '\t'.join([ header[i] for i in range(len(header))
-                              if header[i] not in self.strip_columns ])
+            strip = frozenset(self.strip_columns)
+            keep = [ i for i, h in enumerate(header) if h not in strip ]
+            yield '\t'.join([ header[i] for i in keep ])
+            # Stripped columns behind the last kept one are left unsplit
+            n_split = keep[-1] + 1 if keep else 0
+            if len(keep) == 1:
+                i = keep[0]
+                for line in lines:
+                    yield line.split('\t', n_split)[i]
+                return
+            project = itemgetter(*keep) if keep else lambda _: ()
             for line in lines:
-                line = line.split('\t')
-                yield '\t'.join([ line[i] for i in range(len(line))
-                                  if header[i] not in self.strip_columns ])
+                yield '\t'.join(project(line.split('\t', n_split)))
     def ensure_loaded(self):
         self.file_reader.ensure_loaded()
     def strip(self, column: str):
@@ -134,7 +261,7 @@ class InputFile():
         return InputFile(filename = self.file_reader.filename,
                          file_reader = self.file_reader,
                          strip_columns = [ column ] + self.strip_columns)
-    def column(self, column: str, map_f=lambda x: x):
+    def column(self, column: str, map_f=None):
         """
         Return an iterable over the contents found in a specified column
         of this file. If map_f is supplied, that function will be applied
@@ -142,6 +269,61 @@ class InputFile():
         formats, such as json.
         """
         return Column(corpus=self, column=column, map_f=map_f)
+    @property
+    def id_index(self) -> dict:
+        """
+        Dictionary mapping each document id to the index of its row (not
+        counting the header). The dictionary is built on first access and
+        kept for later use.
+        """
+        if self._id_index is None:
+            self._id_index = { d: i for i, d in enumerate(self.column('id')) }
+        return self._id_index
+    def header_index(self, header_line: str) -> dict:
+        """
+        Map each column name in header_line, the first line yielded when
+        iterating over this file, to the position of that column. The
+        mapping is only computed once and reused as long as the header
+        line stays the same.
+        """
+        if self._header_index is None or \
+                self._header_index[0] != header_line:
+            header = header_line.split('\t')
+            index = { h: i for i, h in reversed(list(enumerate(header))) }
+            self._header_index = (header_line, index)
+        return self._header_index[1]
+    def header(self) -> list:
+        """
+        Return the list of column names found in this file.
+        """
+        try:
+            return next(iter(self)).split('\t')
+        except StopIteration as e:
+            raise ExpectedRuntimeError('Input file is empty') from e
+    def columns(self, columns: list, map_f: dict={}):
+        """
+        Iterate over the contents of several columns of this file in a
+        single pass, yielding one tuple per row with the values in the
+        order of the columns specified. map_f may be a dictionary mapping
+        some of the column names to functions, which will be applied to
+        the contents of these columns.
+        """
+        lines = iter(self)
+        try:
+            header = self.header_index(next(lines))
+        except StopIteration as e:
+            raise ExpectedRuntimeError('Input file is empty') from e
+        for c in columns:
+            if c not in header:
+                raise ColumnNotFound(f"Column '{c}' does "
+                                      'not exist in the input file')
+        i_cols = [ header[c] for c in columns ]
+        maps = [ map_f.get(c) for c in columns ]
+        n_split = max(i_cols, default=-1) + 1
+        for line in lines:
+            line = line.split('\t', n_split)
+            yield tuple( line[i] if f is None else f(line[i])
+                         for i, f in zip(i_cols, maps) )
     def __len__(self):
         return len(self.file_reader)
 
@@ -159,11 +341,13 @@ class Column():
     to those columns to determine inclusion. Any column in the corpus can
     be used to filter contents.
     """
-    def __init__(self, corpus: InputFile, column: str, map_f=lambda x: x,
+    def __init__(self, corpus: InputFile, column: str, map_f=None,
                  filter_by=[], filters=[]):
         self.corpus = corpus
         self.column = column
-        self.map_f = map_f
+        # The standard library's json.loads is swapped for json_loads,
+        # which uses orjson if it is installed
+        self.map_f = json_loads if map_f is json.loads else map_f
         self._len = None
         self.filter_by = filter_by
         self.filters = filters
@@ -173,7 +357,7 @@ class Column():
     def __iter__(self):
         lines = iter(self.corpus)
         try:
-            header = next(lines).split('\t')
+            header = self.corpus.header_index(next(lines))
             if self.column not in header:
                 raise ColumnNotFound(f"Column '{self.column}' does "
                                       'not exist in the input file')
@@ -181,20 +365,40 @@ class Column():
                 if c not in header:
                     raise ColumnNotFound(f"Column '{c}' does "
                                          'not exist in the input file')
-            i_col = header.index(self.column)
-            i_filters = [ header.index(c) for c in self.filter_by ]
+            i_col = header[self.column]
+            filters = tuple( (header[c], f) for c, f
+                             in zip(self.filter_by, self.filters) )
         except StopIteration as e:
             raise ExpectedRuntimeError('Input file is empty') from e
+        map_f = self.map_f
+        # Fields behind the last one needed are left unsplit
+        n_split = max([i_col] + [ i for i, _ in filters ]) + 1
+        if map_f is None and not filters:
+            for line in lines:
+                yield line.split('\t', n_split)[i_col]
+            return
         for line in lines:
-            line = line.split('\t')
-            for j, f in enumerate(self.filters):
-                if not f(line[i_filters[j]]): break
+            line = line.split('\t', n_split)
+            for i, f in filters:
+                if not f(line[i]): break
             else:
-                yield self.map_f(line[i_col])
+                yield line[i_col] if map_f is None else map_f(line[i_col])
     def filter(self, column: str, f):
         return Column(self.corpus, self.column, self.map_f,
                       [column] + self.filter_by, [f] + self.filters)
     def __len__(self):
+        if self._len == None and not self.filters:
+            # Without filters, every line but the header is a row. Counting
+            # the lines first also completes the cache for stdin, so the
+            # header can safely be checked on its own afterwards.
+            n_lines = len(self.corpus)
+            header = self.corpus.header_index(next(iter(self.corpus), ''))
+            if n_lines == 0:
+                raise ExpectedRuntimeError('Input file is empty')
+            elif self.column not in header:
+                raise ColumnNotFound(f"Column '{self.column}' does "
+                                      'not exist in the input file')
+            self._len = n_lines - 1
         if self._len == None: self._len = sum((1 for _ in self))
         return self._len
     def ensure_loaded(self):
@@ -210,12 +414,15 @@ class Column():
         the data appear to be.
         """
         if len(self) == 0: raise EmptyColumnError()
-        entries, zeros = 0, 0
-        for _, row in zip(range(10), self):
-            entries += len(row)
-            zeros   += sum((1 for cell in row if cell == 0))
-        return self.sparse_matrix(dtype=dtype) if zeros/entries > .5 else \
-               self.dense_matrix(dtype=dtype)
+        # The rows used for the decision are reused for the matrix, so
+        # they are neither read nor mapped twice
+        rows = iter(self)
+        head = list(islice(rows, 10))
+        entries = sum(len(row) for row in head)
+        zeros   = sum(1 for row in head for cell in row if cell == 0)
+        build = self._sparse_matrix if zeros/entries > .5 else \
+                self._dense_matrix
+        return build(chain(head, rows), head[0], dtype)
     def dense_matrix(self, dtype=None):
         """
         Return the data as a numpy.ndarray. Note that this only works if
@@ -223,12 +430,7 @@ class Column():
         numpy. Lists of ints or floats work fine, for instance.
         """
         if len(self) == 0: raise EmptyColumnError()
-        n_rows, n_cols = len(self), len(self.peek())
-        if dtype == None: dtype = type(self.peek()[0])
-        m = np.ndarray((n_rows, n_cols), dtype=dtype)
-        for i, v in enumerate(iter(self)):
-            m[i] = v
-        return m
+        return self._dense_matrix(iter(self), self.peek(), dtype)
     def sparse_matrix(self, dtype=None):
         """
         Return the data as a scipy.sparse.csr_matrix. Note that this only
@@ -236,15 +438,47 @@ class Column():
         by scipy. Lists of ints or floats work fine, for instance.
         """
         if len(self) == 0: raise EmptyColumnError()
-        row, col, data = [], [], []
-        for i, v in enumerate(iter(self)):
-            for j, cell in enumerate(v):
-                if cell == 0: continue
-                row.append(i); col.append(j); data.append(cell)
-        n_rows, n_cols = len(self), len(self.peek())
-        if dtype == None: dtype = type(self.peek()[0])
-        return csr_matrix((data, (row, col)), shape=(n_rows, n_cols),
-                          dtype=dtype)
+        return self._sparse_matrix(iter(self), self.peek(), dtype)
+    def _dense_matrix(self, rows, first, dtype):
+        n_rows, n_cols = len(self), len(first)
+        if dtype == None: dtype = type(first[0])
+        m = np.ndarray((n_rows, n_cols), dtype=dtype)
+        # Assigning blocks of rows lets numpy convert many lists in one call
+        block = max(1, (1 << 18) // n_cols)
+        for start in range(0, n_rows, block):
+            v = list(islice(rows, block))
+            m[start:start+len(v)] = v
+        return m
+    def _sparse_matrix(self, rows, first, dtype):
+        from scipy.sparse import vstack
+        n_rows, n_cols = len(self), len(first)
+        if dtype == None: dtype = type(first[0])
+        # Rows are collected in dense blocks of about 4M cells, each of
+        # which is converted to a sparse matrix by numpy and scipy
+        block = np.zeros((min(n_rows, max(1, (1 << 22) // n_cols)), n_cols),
+                         dtype=dtype)
+        blocks, k = [], 0
+        for v in rows:
+            block[k] = v; k += 1
+            if k == len(block):
+                blocks.append(_csr_from_dense(block)); k = 0
+        if k > 0 or not blocks: blocks.append(_csr_from_dense(block[:k]))
+        return vstack(blocks, format='csr', dtype=dtype)
+
+def _csr_from_dense(m):
+    """
+    Convert a dense 2d array to a csr_matrix. The nonzero entries are
+    found with a single pass over the flattened array, which is faster
+    than scipy's conversion through an intermediate coo_matrix.
+    """
+    n_rows, n_cols = m.shape
+    flat = m.ravel()
+    nonzero = np.flatnonzero(flat)
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nonzero // n_cols, minlength=n_rows),
+              out=indptr[1:])
+    return csr_matrix((flat[nonzero], nonzero % n_cols, indptr),
+                      shape=(n_rows, n_cols))
 
 class PsqPairs():
     """
@@ -254,7 +488,31 @@ class PsqPairs():
     """
     def __init__(self, filename):
         self.file_reader = CachingFileReader(filename)
+        self._ndarray, self._ndarray_ids = None, None
     def __iter__(self):
         for line in self.file_reader:
             a, b = line.split('\t')
             yield (a, b)
+    def __getstate__(self):
+        # Open files cannot be sent to other processes, so the lines
+        # are sent instead. Iterating over a list works just the same.
+        state = self.__dict__.copy()
+        state['file_reader'] = list(self.file_reader)
+        return state
+    def as_ndarray(self, ids, index: dict=None) -> np.ndarray:
+        """
+        Return the pairs as a numpy array of shape (N, 2), where each
+        document id is replaced by its index in ids. The ids should be the
+        document ids found in the input file, in order. If the mapping of
+        ids to indices is already known (see InputFile.id_index), it can be
+        passed as index to avoid building it again. The array for the
+        most recent ids is memoized, since many input files share the same
+        ids and row order.
+        """
+        ids = np.asarray(ids, dtype=object)
+        if self._ndarray is None or not np.array_equal(ids, self._ndarray_ids):
+            if index is None: index = { d: i for i, d in enumerate(ids) }
+            pairs = [ (index[a], index[b]) for a, b in self ]
+            self._ndarray = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+            self._ndarray_ids = ids
+        return self._ndarray